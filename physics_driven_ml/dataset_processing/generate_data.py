@@ -1,35 +1,181 @@
 import os
+import logging
 import argparse
+import tempfile
+import functools
+import multiprocessing
 import numpy as np
+import torch
 from typing import Union, Callable
+from concurrent.futures import ProcessPoolExecutor
 from tqdm.auto import tqdm, trange
 from numpy.random import default_rng
+from numba import njit, prange
 
 from firedrake import *
 
 from physics_driven_ml.utils import get_logger
 
 
+logger = logging.getLogger("Data generation")
+
+
+@njit(parallel=True, fastmath=True)
+def _eval_modes(X, Y, a, b, k1, k2, out):
+    """Evaluate the sum of the modes (a, b, k1, k2) of each sample at the points (X, Y) and store it in `out`."""
+    N, m = a.shape
+    ndof = X.shape[0]
+    # Parallelise over both samples and nodes
+    for p in prange(N * ndof):
+        s, i = p // ndof, p % ndof
+        r = 0.
+        for j in range(m):
+            θ = 2 * np.pi * (k1[s, j] * X[i] + k2[s, j] * Y[i])
+            r += a[s, j] * np.cos(θ) + b[s, j] * np.sin(θ)
+        out[s, i] = np.sqrt(1 / m) * r
+
+
+def _eval_modes_torch(X, Y, a, b, k1, k2, device: str):
+    """Evaluate the sum of the modes (a, b, k1, k2) of each sample at the points (X, Y) on a PyTorch device.
+
+    The evaluation is carried out in single precision, by batches of samples to bound the memory footprint.
+    """
+    N, m = a.shape
+    ndof = X.shape[0]
+    X, Y = [torch.tensor(e, dtype=torch.float32, device=device) for e in (X, Y)]
+    R = np.empty((N, ndof))
+    # Number of samples such that each (batch_size, m, ndof) array has about 2 ** 24 entries
+    batch_size = max(1, 2 ** 24 // (m * ndof))
+    for s in range(0, N, batch_size):
+        a_s, b_s, k1_s, k2_s = [torch.tensor(e[s:s + batch_size], dtype=torch.float32, device=device)
+                                for e in (a, b, k1, k2)]
+        # θ has shape (batch_size, m, ndof)
+        θ = 2 * np.pi * (k1_s[..., None] * X + k2_s[..., None] * Y)
+        r = (a_s[..., None] * torch.cos(θ) + b_s[..., None] * torch.sin(θ)).sum(dim=1)
+        # Cast back to double precision
+        R[s:s + batch_size] = (np.sqrt(1 / m) * r).cpu().numpy()
+    return R
+
+
+# Bounded, since cached function spaces and their meshes are kept in memory
+@functools.lru_cache(maxsize=4)
+def _node_coordinates(V):
+    """Return the coordinates (X, Y) of the nodes of V."""
+    mesh = V.mesh()
+    W = VectorFunctionSpace(mesh, V.ufl_element())
+    return Function(W).interpolate(SpatialCoordinate(mesh)).dat.data_ro.T
+
+
 def random_field(V, N: int = 1, m: int = 5, σ: float = 0.6,
-                 tqdm: bool = False, seed: int = 2023):
-    """Generate N 2D random fields with m modes."""
+                 tqdm: bool = False, seed: Union[int, np.random.Generator] = 2023,
+                 device: str = "cpu"):
+    """Generate N 2D random fields with m modes.
+
+    The fields are evaluated numerically at the nodes of `V`, which is assumed to be a Lagrange space.
+    If `device` is not "cpu", the evaluation is carried out by PyTorch on the given device (e.g. "cuda:0").
+    """
     rng = default_rng(seed)
-    x, y = SpatialCoordinate(V.ufl_domain())
+    # Draw the coefficients (a, b, k1, k2) of all the modes at once, in the same order as drawing them mode by mode
+    z = rng.standard_normal((N, m, 4))
+    a, b = z[..., 0], z[..., 1]
+    k1, k2 = σ * z[..., 2], σ * z[..., 3]
+    # Get the coordinates of the nodes of V
+    X, Y = _node_coordinates(V)
+    # Evaluate all the fields at once
+    if device == "cpu":
+        R = np.empty((N, len(X)))
+        _eval_modes(X, Y, a, b, k1, k2, R)
+    else:
+        R = _eval_modes_torch(X, Y, a, b, k1, k2, device)
     fields = []
-    for _ in trange(N, disable=not tqdm):
-        r = 0
-        for _ in range(m):
-            a, b = rng.standard_normal(2)
-            k1, k2 = rng.normal(0, σ, 2)
-            θ = 2 * pi * (k1 * x + k2 * y)
-            r += Constant(a) * cos(θ) + Constant(b) * sin(θ)
-        fields.append(interpolate(sqrt(1 / m) * r, V))
+    for i in trange(N, disable=not tqdm):
+        f = Function(V)
+        f.dat.data[:] = R[i]
+        fields.append(f)
     return fields
 
 
+def _save_samples(afile, V, name: str, fs, dtype=np.float64):
+    """Save functions of V as the rows of a single (n, V.dim()) dataset in one write.
+
+    Columns are ordered according to the global numbering of the nodes of V, which is stored in
+    the file as the `dof_index` function so that the datasets can be reordered when loading the mesh.
+    """
+    n, ndof = len(fs), V.dim()
+    start, end = V.dof_dset.layout_vec.getOwnershipRange()
+    # Chunks of a few MB
+    nrows = max(1, min(n, 2 ** 22 // (np.dtype(dtype).itemsize * ndof)))
+    dset = afile.h5pyfile.create_dataset(name, shape=(n, ndof), dtype=dtype,
+                                         chunks=(nrows, ndof) if n else None)
+    if n:
+        # Each rank writes the columns corresponding to the nodes it owns
+        dset[:, start:end] = np.stack([f.dat.data_ro for f in fs]).astype(dtype)
+
+
+def _heat_solver(V):
+    """Set up the heat problem on V and return a function solving it for a given parameter k.
+
+    The returned function always returns the same Firedrake function, which is overwritten by the next solve.
+    """
+    v = TestFunction(V)
+    x, y = SpatialCoordinate(V.ufl_domain())
+    f = Function(V).interpolate(sin(pi * x) * sin(pi * y))
+    bcs = [DirichletBC(V, Constant(0.0), "on_boundary")]
+    # Set up the solver once and only update the conductivity κ = exp(k) for each sample
+    k = Function(V)
+    κ = Function(V)
+    # Reuse the same interpolation kernel for all samples
+    interpolator = Interpolator(exp(k), V)
+    u = Function(V)
+    F = (inner(κ * grad(u), grad(v)) - inner(f, v)) * dx
+    problem = NonlinearVariationalProblem(F, u, bcs=bcs)
+    # Solve PDE (linear in u) using conjugate gradient preconditioned with algebraic multigrid
+    solver_parameters = {'snes_type': 'ksponly',
+                         'ksp_type': 'cg',
+                         'ksp_rtol': 1e-10,
+                         'pc_type': 'hypre',
+                         'pc_hypre_type': 'boomeramg'}
+    solver = NonlinearVariationalSolver(problem, solver_parameters=solver_parameters)
+
+    def solve_heat(ki):
+        k.assign(ki)
+        interpolator.interpolate(output=κ)
+        u.assign(0)
+        solver.solve()
+        return u
+
+    return solve_heat
+
+
+# State of the worker processes solving the heat problem
+_worker = {}
+
+
+def _init_worker(fname: str, mesh_name: str):
+    """Load the mesh saved in `fname` and set up the heat problem solver in a worker process."""
+    with CheckpointFile(fname, "r", comm=COMM_SELF) as afile:
+        mesh = afile.load_mesh(mesh_name)
+        dof_index = afile.load_function(mesh, "dof_index")
+    V = dof_index.function_space()
+    _worker["k"] = Function(V)
+    _worker["solve_heat"] = _heat_solver(V)
+    # Position of the nodes of the loaded mesh in the node numbering of the parent process
+    _worker["idx"] = np.rint(dof_index.dat.data_ro).astype(int)
+
+
+def _solve_one(k_vec):
+    """Solve the heat problem in a worker process, with `k_vec` ordered as the nodes of the parent process."""
+    k, idx = _worker["k"], _worker["idx"]
+    k.dat.data[:] = k_vec[idx]
+    u = _worker["solve_heat"](k)
+    u_vec = np.empty_like(k_vec)
+    u_vec[idx] = u.dat.data_ro
+    return u_vec
+
+
 def generate_data(V, dataset_dir: str, ntrain: int = 50, ntest: int = 10,
                   forward: Union[str, Callable] = "heat", noise: Union[str, Callable] = "normal",
-                  scale_noise: float = 1., seed: int = 1234):
+                  scale_noise: float = 1., seed: int = 1234, device: str = "cpu", nworkers: int = 1):
     """Generate train/test data for a given PDE-based forward problem and noise distribution.
 
     Parameters:
@@ -41,6 +187,8 @@ def generate_data(V, dataset_dir: str, ntrain: int = 50, ntest: int = 10,
         - noise: noise distribution to form the observed data (e.g. "normal")
         - scale_noise: noise scaling factor
         - seed: random seed
+        - device: device on which the random fields are evaluated (e.g. "cpu" or "cuda:0")
+        - nworkers: number of processes solving the "heat" forward problem when MPI is not used (see below)
 
     Custom forward problems:
         One can provide a custom forward problem by specifying a callable for the `forward` argument.
@@ -51,41 +199,91 @@ def generate_data(V, dataset_dir: str, ntrain: int = 50, ntest: int = 10,
         Likewise, one can provide a custom noise perturbation by specifying a callable for the `noise` argument.
         This callable should take in a list of PDE solutions, and it should return a list of Firedrake functions
         corresponding to the observed data, i.e. the perturbed PDE solutions.
+
+    Storage:
+        The observed data are saved in single precision to halve their size on disk, while the parameters `k`
+        are kept in double precision. Observations are loaded back as (double precision) Firedrake functions.
+
+    Parallelism:
+        If the mesh of `V` is not distributed (e.g. it has been created on COMM_SELF), the PDE solves are
+        distributed across the MPI ranks of COMM_WORLD, and the data is gathered and saved on rank 0.
+        Without MPI, the "heat" forward problems can instead be solved by a pool of `nworkers` processes.
+        This only applies when `forward == "heat"`, and since the worker processes are spawned, the entry
+        point of the calling script must be guarded by `if __name__ == "__main__":`.
     """
 
+    mesh = V.mesh()
+    # Shard the samples across MPI ranks when each rank holds its own copy of the mesh
+    comm = COMM_WORLD if mesh.comm.size == 1 else COMM_SELF
+    rank, size = comm.rank, comm.size
+    # Only display progress bars on the first process
+    progress = COMM_WORLD.rank == 0
+
+    # Global numbering of the nodes of V, used to order the columns of the saved datasets
+    start, end = V.dof_dset.layout_vec.getOwnershipRange()
+    dof_index = Function(V, name="dof_index")
+    dof_index.dat.data[:] = np.arange(start, end)
+
+    rng = default_rng(seed)
+
     logger.info("\n Generate random fields")
 
-    ks = random_field(V, N=ntrain+ntest, tqdm=True, seed=seed)
+    ks = random_field(V, N=ntrain+ntest, tqdm=progress, seed=rng, device=device)
 
     logger.info("\n Generate corresponding PDE solutions")
 
-    if forward == "heat":
-        us = []
-        v = TestFunction(V)
-        x, y = SpatialCoordinate(V.ufl_domain())
-        f = Function(V).interpolate(sin(pi * x) * sin(pi * y))
-        bcs = [DirichletBC(V, Constant(0.0), "on_boundary")]
-        for k in tqdm(ks):
-            u = Function(V)
-            F = (inner(exp(k) * grad(u), grad(v)) - inner(f, v)) * dx
-            # Solve PDE using LU factorisation
-            solve(F == 0, u, bcs=bcs, solver_parameters={'ksp_type': 'preonly', 'pc_type': 'lu'})
-            us.append(u)
+    # Samples handled by this rank
+    ks_local = ks[rank::size]
+
+    if forward == "heat" and nworkers > 1 and COMM_WORLD.size == 1:
+        # Workers set up their own copy of the problem from the mesh saved in a checkpoint file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, "mesh.h5")
+            with CheckpointFile(fname, "w", comm=mesh.comm) as afile:
+                afile.save_mesh(mesh)
+                afile.save_function(dof_index)
+            # Spawn rather than fork the workers since MPI is initialised in the parent process
+            with ProcessPoolExecutor(max_workers=nworkers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker, initargs=(fname, mesh.name)) as executor:
+                # Send several samples per task to amortise the inter-process communication
+                chunksize = max(1, len(ks) // (4 * nworkers))
+                us_np = list(tqdm(executor.map(_solve_one, [k.dat.data_ro for k in ks], chunksize=chunksize),
+                                  total=len(ks), disable=not progress))
+        us = [Function(V, val=u) for u in us_np]
+    elif forward == "heat":
+        solve_heat = _heat_solver(V)
+        us = [solve_heat(k).copy(deepcopy=True) for k in tqdm(ks_local, disable=not progress)]
     elif callable(forward):
-        us = forward(ks, V)
+        us = forward(ks_local, V)
     else:
         raise NotImplementedError("Forward problem not implemented. Use 'heat' or provide a callable for your forward problem.")
 
+    if size > 1:
+        # Gather the PDE solutions on rank 0
+        us_ranks = comm.gather([u.dat.data_ro.copy() for u in us], root=0)
+        if rank != 0:
+            return
+        us = [None] * len(ks)
+        for r, us_r in enumerate(us_ranks):
+            for i, u in zip(range(r, len(ks), size), us_r):
+                us[i] = Function(V, val=u)
+
     logger.info("\n Form noisy observations from PDE solutions")
 
     if noise == "normal":
-        us_obs = []
-        for u in tqdm(us):
-            u_obs = Function(V).assign(u)
-            noise = scale_noise * np.random.rand(V.dim())
-            # Add noise to PDE solutions
-            u_obs.dat.data[:] += noise
-            us_obs.append(u_obs)
+        if callable(forward):
+            # Custom forward problems may return functions used elsewhere (e.g. the inputs `ks`)
+            us = [u.copy(deepcopy=True) for u in us]
+        # Draw the noise of each sample into the same buffer. The noise is drawn for all the nodes of V and each
+        # rank keeps the nodes it owns, so that the noise does not depend on the mesh partitioning
+        buf = np.empty(V.dim())
+        ε = buf[start:end]
+        for u in tqdm(us, disable=not progress):
+            rng.standard_normal(out=buf)
+            np.multiply(ε, scale_noise, out=ε)
+            # Add noise to PDE solutions in place since they are not saved and not aliased
+            np.add(u.dat.data, ε, out=u.dat.data)
+        us_obs = us
     elif callable(noise):
         us_obs = noise(us)
     else:
@@ -93,32 +291,24 @@ def generate_data(V, dataset_dir: str, ntrain: int = 50, ntest: int = 10,
 
     logger.info(f"\n Generated {ntrain} training samples and {ntest} test samples.")
 
-    # Split into train/test
-    ks_train, ks_test = ks[:ntrain], ks[ntrain:]
-    us_train, us_test = us[:ntrain], us[ntrain:]
-    us_obs_train, us_obs_test = us_obs[:ntrain], us_obs[ntrain:]
-
     logger.info(f"\n Saving train/test data to {os.path.abspath(dataset_dir)}.")
 
-    # Save train data
-    with CheckpointFile(os.path.join(dataset_dir, "train_data.h5"), "w") as afile:
-        afile.h5pyfile["n"] = ntrain
-        afile.save_mesh(mesh)
-        for i, (k, u, u_obs) in enumerate(zip(ks_train, us_train, us_obs_train)):
-            afile.save_function(k, idx=i, name="k")
-            afile.save_function(u_obs, idx=i, name="u_obs")
-
-    # Save test data
-    with CheckpointFile(os.path.join(dataset_dir, "test_data.h5"), "w") as afile:
-        afile.h5pyfile["n"] = ntest
+    # Save train and test data in the same file to only store the mesh once
+    with CheckpointFile(os.path.join(dataset_dir, "data.h5"), "w", comm=mesh.comm) as afile:
         afile.save_mesh(mesh)
-        for i, (k, u, u_obs) in enumerate(zip(ks_test, us_test, us_obs_test)):
-            afile.save_function(k, idx=i, name="k")
-            afile.save_function(u_obs, idx=i, name="u_obs")
+        afile.save_function(dof_index)
+        # Split into train/test
+        for split, idx in [("train", slice(None, ntrain)), ("test", slice(ntrain, None))]:
+            afile.h5pyfile.create_group(split)
+            _save_samples(afile, V, f"{split}/k", ks[idx])
+            # Observations are stored in single precision
+            _save_samples(afile, V, f"{split}/u_obs", us_obs[idx], dtype=np.float32)
 
 
 if __name__ == "__main__":
     logger = get_logger("Data generation")
+    if COMM_WORLD.rank != 0:
+        logger.setLevel(logging.WARNING)
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--ntrain", default=50, type=int, help="Number of training samples")
@@ -133,11 +323,13 @@ if __name__ == "__main__":
     parser.add_argument("--degree", default=1, type=int, help="Degree of the finite element CG space")
     parser.add_argument("--data_dir", default=os.environ["DATA_DIR"], type=str, help="Data directory")
     parser.add_argument("--dataset_name", default="heat_conductivity", type=str, help="Dataset name")
+    parser.add_argument("--device", default="cpu", type=str, help="Device identifier for generating the random fields (e.g. 'cuda:0' or 'cpu')")
+    parser.add_argument("--nworkers", default=1, type=int, help="Number of processes solving the forward problem when MPI is not used")
 
     args = parser.parse_args()
 
-    # Set up mesh and finite element space
-    mesh = RectangleMesh(args.nx, args.ny, args.Lx, args.Ly, name="mesh")
+    # Set up mesh and finite element space (each rank has its own copy of the mesh and handles a subset of the samples)
+    mesh = RectangleMesh(args.nx, args.ny, args.Lx, args.Ly, name="mesh", comm=COMM_SELF)
     V = FunctionSpace(mesh, "CG", args.degree)
     # Set up data directory
     dataset_dir = os.path.join(args.data_dir, "datasets", args.dataset_name)
@@ -150,4 +342,5 @@ if __name__ == "__main__":
     # Generate data
     generate_data(V, dataset_dir=dataset_dir, ntrain=args.ntrain,
                   ntest=args.ntest, forward=args.forward,
-                  noise=args.noise, scale_noise=args.scale_noise)
+                  noise=args.noise, scale_noise=args.scale_noise,
+                  device=args.device, nworkers=args.nworkers)
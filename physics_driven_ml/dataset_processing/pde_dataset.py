@@ -3,7 +3,7 @@ import numpy as np
 import torch
 
 from typing import List
-from firedrake import CheckpointFile, load_backend
+from firedrake import CheckpointFile, Function, load_backend
 from torch.utils.data import Dataset
 
 from physics_driven_ml.dataset_processing import BatchElement, BatchedElement
@@ -19,26 +19,44 @@ class PDEDataset(Dataset):
             raise ValueError(f"Dataset directory {os.path.abspath(dataset_dir)} does not exist")
 
         # Get mesh and batch elements (Firedrake functions)
-        name_file = dataset_split + "_data.h5"
-        mesh, batch_elements = self.load_dataset(os.path.join(dataset_dir, name_file))
+        fname = os.path.join(dataset_dir, "data.h5")
+        if not os.path.exists(fname):
+            # Train and test data are stored in separate files
+            fname = os.path.join(dataset_dir, dataset_split + "_data.h5")
+        mesh, batch_elements = self.load_dataset(fname, dataset_split)
         self.mesh = mesh
         self.batch_elements_fd = batch_elements
 
         # Get PyTorch backend from Firedrake (for mapping from Firedrake to PyTorch and vice versa)
         self._fd_backend = load_backend()
 
-    def load_dataset(self, fname: str):
+    def load_dataset(self, fname: str, dataset_split: str = "train"):
         data = []
         # Load data
         with CheckpointFile(fname, "r") as afile:
-            n = int(np.array(afile.h5pyfile["n"]))
             # Load mesh
             mesh = afile.load_mesh("mesh")
             # Load data
-            for i in range(n):
-                k = afile.load_function(mesh, "k", idx=i)
-                u_obs = afile.load_function(mesh, "u_obs", idx=i)
-                data.append((k, u_obs))
+            if dataset_split in afile.h5pyfile:
+                # Samples are stored as the rows of (n, ndof) datasets in the group of the split
+                group = afile.h5pyfile[dataset_split]
+                dof_index = afile.load_function(mesh, "dof_index")
+                V = dof_index.function_space()
+                # Columns of the datasets corresponding to the nodes of V
+                cols = np.rint(dof_index.dat.data_ro).astype(int)
+                ks, us_obs = [group[name][()][:, cols] for name in ("k", "u_obs")]
+                for i in range(len(ks)):
+                    k, u_obs = Function(V), Function(V)
+                    k.dat.data[:] = ks[i]
+                    u_obs.dat.data[:] = us_obs[i]
+                    data.append((k, u_obs))
+            else:
+                # Samples are stored as timestepped functions
+                n = int(np.array(afile.h5pyfile["n"]))
+                for i in range(n):
+                    k = afile.load_function(mesh, "k", idx=i)
+                    u_obs = afile.load_function(mesh, "u_obs", idx=i)
+                    data.append((k, u_obs))
         return mesh, data
 
     def __len__(self) -> int:
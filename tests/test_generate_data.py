@@ -0,0 +1,163 @@
+import os
+import pytest
+import numpy as np
+from numpy.random import default_rng
+
+from firedrake import *
+
+from physics_driven_ml.dataset_processing import random_field, generate_data, PDEDataset
+from physics_driven_ml.dataset_processing.generate_data import _node_coordinates, _eval_modes, _eval_modes_torch
+
+
+@pytest.fixture(scope="module")
+def mesh():
+    return UnitSquareMesh(10, 10)
+
+
+@pytest.fixture(scope="module", params=[1, 2])
+def V(request, mesh):
+    return FunctionSpace(mesh, "CG", request.param)
+
+
+def random_field_ufl(V, N, m, σ, seed):
+    """Reference implementation interpolating the symbolic expression of the random fields"""
+    rng = default_rng(seed)
+    x, y = SpatialCoordinate(V.ufl_domain())
+    fields = []
+    for _ in range(N):
+        r = 0
+        for _ in range(m):
+            a, b = rng.standard_normal(2)
+            k1, k2 = rng.normal(0, σ, 2)
+            θ = 2 * pi * (k1 * x + k2 * y)
+            r += Constant(a) * cos(θ) + Constant(b) * sin(θ)
+        fields.append(interpolate(sqrt(1 / m) * r, V))
+    return fields
+
+
+@pytest.mark.parametrize("N, m", [(1, 5), (4, 15)])
+def test_random_field(V, N, m):
+    """Check the random fields against their symbolic definition"""
+    fields = random_field(V, N=N, m=m, σ=0.6, seed=2023)
+    fields_exact = random_field_ufl(V, N=N, m=m, σ=0.6, seed=2023)
+
+    assert len(fields) == N
+    for f, f_exact in zip(fields, fields_exact):
+        assert np.allclose(f.dat.data_ro, f_exact.dat.data_ro)
+
+
+def test_random_field_seed(V):
+    """Check that the random fields only depend on the seed and on their index"""
+    fields = random_field(V, N=4, seed=2023)
+    # Seeding with a generator is equivalent to seeding with an integer
+    fields_rng = random_field(V, N=4, seed=default_rng(2023))
+    # The coefficients of all the samples are drawn at once, sample by sample
+    fields_prefix = random_field(V, N=2, seed=2023)
+
+    for f, f_rng in zip(fields, fields_rng):
+        assert np.allclose(f.dat.data_ro, f_rng.dat.data_ro)
+    for f, f_prefix in zip(fields, fields_prefix):
+        assert np.allclose(f.dat.data_ro, f_prefix.dat.data_ro)
+
+
+def test_eval_modes_torch():
+    """Check the PyTorch evaluation of the modes against the Numba kernel"""
+    rng = default_rng(0)
+    X, Y = rng.random((2, 200))
+    a, b, k1, k2 = rng.standard_normal((4, 7, 15))
+    R = np.empty((7, 200))
+    _eval_modes(X, Y, a, b, k1, k2, R)
+    R_torch = _eval_modes_torch(X, Y, a, b, k1, k2, device="cpu")
+    assert R_torch.dtype == np.float64
+    # The PyTorch evaluation is carried out in single precision
+    assert np.allclose(R_torch, R, atol=1e-4)
+
+
+@pytest.fixture(scope="module")
+def small_V():
+    # Datasets are loaded using the mesh name "mesh"
+    mesh = UnitSquareMesh(4, 4, name="mesh")
+    return FunctionSpace(mesh, "CG", 1)
+
+
+def zero_forward(ks, V):
+    """Forward problem returning zero solutions, such that the observed data only consist of noise"""
+    return [Function(V) for _ in ks]
+
+
+def make_dataset(V, data_dir, name, ntrain=3, ntest=1, forward=zero_forward, nworkers=1):
+    """Generate a dataset in `data_dir` and return the PDEDataset of each split"""
+    dataset_dir = data_dir / "datasets" / name
+    dataset_dir.mkdir(parents=True)
+    generate_data(V, dataset_dir=str(dataset_dir), ntrain=ntrain, ntest=ntest, forward=forward,
+                  noise="normal", scale_noise=1., seed=1234, nworkers=nworkers)
+    # Both splits are stored in a single file
+    assert sorted(os.listdir(dataset_dir)) == ["data.h5"]
+    return {split: PDEDataset(dataset=name, dataset_split=split, data_dir=str(data_dir))
+            for split in ("train", "test")}
+
+
+def node_permutation(V, V_loaded):
+    """Return the indices of the nodes of V matching the nodes of V_loaded, based on their coordinates"""
+    X, X_loaded = [np.round(np.transpose(_node_coordinates(W)), 12) for W in (V, V_loaded)]
+    idx, idx_loaded = [np.lexsort(x.T) for x in (X, X_loaded)]
+    perm = np.empty_like(idx)
+    perm[idx_loaded] = idx
+    return perm
+
+
+def samples(dataset, V):
+    """Return the parameters and observations of a dataset as (n, V.dim()) arrays ordered as the nodes of V"""
+    ks, us_obs = np.empty((len(dataset), V.dim())), np.empty((len(dataset), V.dim()))
+    for i, (k, u_obs) in enumerate(dataset.batch_elements_fd):
+        perm = node_permutation(V, k.function_space())
+        ks[i, perm] = k.dat.data_ro
+        us_obs[i, perm] = u_obs.dat.data_ro
+    return ks, us_obs
+
+
+@pytest.mark.parametrize("ntest", [2, 0])
+def test_generate_data_round_trip(tmp_path, small_V, ntest):
+    """Check that the train and test data generated by `generate_data` are recovered by `PDEDataset`"""
+    ntrain = 3
+    datasets = make_dataset(small_V, tmp_path, "round_trip", ntrain=ntrain, ntest=ntest)
+
+    # Expected parameters and observations (i.e. noise), ordered as the nodes of V
+    rng = default_rng(1234)
+    ks_exact = np.array([k.dat.data_ro for k in random_field(small_V, N=ntrain+ntest, seed=rng)])
+    us_obs_exact = rng.standard_normal((ntrain+ntest, small_V.dim()))
+
+    for split, idx in [("train", slice(None, ntrain)), ("test", slice(ntrain, None))]:
+        ks, us_obs = samples(datasets[split], small_V)
+        assert len(ks) == len(ks_exact[idx])
+        assert np.allclose(ks, ks_exact[idx])
+        # Observations are stored in single precision
+        assert np.allclose(us_obs, us_obs_exact[idx], rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize("split", ["train", "test"])
+def test_load_legacy_dataset(split):
+    """Check that datasets with one file per split and timestepped functions can still be loaded"""
+    dataset = PDEDataset(dataset="heat_conductivity_paper", dataset_split=split, data_dir=os.environ["DATA_DIR"])
+    assert len(dataset) > 0
+    for k, u_obs in dataset.batch_elements_fd:
+        assert k.function_space() == u_obs.function_space()
+
+
+def test_generate_data_aliased_forward(tmp_path, small_V):
+    """Check that the noise does not alter the parameters when the forward problem returns its inputs"""
+    datasets = make_dataset(small_V, tmp_path, "aliased", ntrain=2, ntest=0, forward=lambda ks, V: ks)
+
+    ks_exact = np.array([k.dat.data_ro for k in random_field(small_V, N=2, seed=default_rng(1234))])
+    ks, _ = samples(datasets["train"], small_V)
+    assert np.allclose(ks, ks_exact)
+
+
+def test_generate_data_nworkers(tmp_path, small_V):
+    """Check that solving the heat problems in a pool of processes gives the same data"""
+    datasets = {nworkers: make_dataset(small_V, tmp_path, f"nworkers_{nworkers}", forward="heat", nworkers=nworkers)
+                for nworkers in (1, 2)}
+
+    for split in ("train", "test"):
+        for d1, d2 in zip(samples(datasets[1][split], small_V), samples(datasets[2][split], small_V)):
+            assert np.allclose(d1, d2)